@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+
+sys.path.insert(0, ROOT)
+
+from stub_server import start_server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time report generation against a local stand-in of the CCKP API.')
+    parser.add_argument('--region', default='AFG.11', help='State Code of the report (default: %(default)s)')
+    parser.add_argument('--era5', nargs='*', metavar='VAR', default=None, help='ERA5 variables (default: all 10)')
+    parser.add_argument('--cmip6', nargs='*', metavar='VAR', default=None, help='CMIP6 variables (default: all 26)')
+    # Same names as cckp_plot.QUALITY, the modules are imported only once the environment is set (see run)
+    parser.add_argument('--quality', choices=['draft', 'standard', 'print'], default='print',
+                        help='quality profile of the figures (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every benchmark, the median is kept (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.1, help='latency of the stub API in seconds (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0., help='standard deviation of the latency (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0., help='fraction of the requests failing (default: %(default)s)')
+    parser.add_argument('--output', help='results file (default: bench/results/<git revision>.json)')
+    parser.add_argument('--compare', metavar='RESULTS', help='results file of another revision to compare with')
+
+    return parser.parse_args(argv)
+
+
+def git_revision():
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return f'{rev}-dirty' if dirty else rev
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def timed(fn, repeat, setup=None):
+    # Median and minimum wall time of fn, setup runs before every call and is not timed
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return {'median': statistics.median(times), 'min': min(times), 'runs': times}
+
+
+def run(args, server, api_url):
+    # The modules read their configuration when imported
+    os.environ['CCKP_API_URL'] = api_url
+    os.environ['CCKP_CACHE_DIR'] = tempfile.mkdtemp(prefix='cckp_bench_')
+
+    import requests
+
+    import cckp_report
+    from cckp_api import fetch_tables, make_url, parse_table
+    from cckp_cache import cache
+    from cckp_store import store
+    from cckp_plot import render_pngs
+    from cckp_report import (ERA5_VARIABLES, CMIP6_VARIABLES, assemble_report, iter_sections, make_spec,
+                             prepare_data, report_series, requested_sections, section_series)
+
+    era_codes = ERA5_VARIABLES if args.era5 is None else args.era5
+    cmip_codes = CMIP6_VARIABLES if args.cmip6 is None else args.cmip6
+    requested = requested_sections(era_codes, cmip_codes)
+    series = report_series(args.region, era_codes, cmip_codes)
+
+    def clear_all():
+        shutil.rmtree(cache.path, ignore_errors=True)
+        store.clear()
+        cckp_report.sections.clear()
+
+    def clear_memory():
+        # Only the disk cache is left
+        store.clear()
+        cckp_report.sections.clear()
+
+    def report(name):
+        # Same path as the dashboard: stream the sections, then write and save the document
+        built = [None] * len(requested)
+        failed = 0
+        for i, item, section in iter_sections(args.region, era_codes, cmip_codes, quality=args.quality):
+            if isinstance(section, Exception):
+                failed += 1
+            else:
+                built[i] = section
+        assemble_report('Country', 'Region', built[:len(era_codes)], built[len(era_codes):]).save(BytesIO())
+        results.setdefault('failed_sections', {})[name] = failed
+
+    results = {}
+    error_rate, server.error_rate = server.error_rate, 0.
+    try:
+        # Stages of the pipeline, one at a time, without injected errors
+        results['fetch'] = timed(lambda: fetch_tables(series), args.repeat, setup=clear_all)
+
+        payloads = [requests.get(make_url(s), timeout=60).json() for s in series]
+        results['parse'] = timed(lambda: [parse_table(p, s) for p, s in zip(payloads, series)], args.repeat)
+
+        tables = iter(fetch_tables(series))
+        groups = [[next(tables) for _ in section_series(*item, args.region)] for item in requested]
+        results['prepare'] = timed(lambda: [prepare_data(dataset, group) for (dataset, var), group in zip(requested, groups)], args.repeat)
+
+        data = [prepare_data(dataset, group) for (dataset, var), group in zip(requested, groups)]
+        specs = [make_spec(dataset, var, d) for (dataset, var), d in zip(requested, data)]
+        render_pngs(specs[:2], args.quality)  # start the render processes
+        results['plot'] = timed(lambda: render_pngs(specs, args.quality), args.repeat)
+
+        built = cckp_report.build_sections(args.region, era_codes, cmip_codes, quality=args.quality, log=lambda msg: None)
+
+        def docx():
+            bio = BytesIO()
+            assemble_report('Country', 'Region', built[:len(era_codes)], built[len(era_codes):]).save(bio)
+            results['docx_bytes'] = len(bio.getvalue())
+
+        results['docx'] = timed(docx, args.repeat)
+
+        # The whole report: nothing cached, series cached on disk only, sections memoized
+        server.error_rate = error_rate
+        results['report_cold'] = timed(lambda: report('report_cold'), args.repeat, setup=clear_all)
+        results['report_disk_cache'] = timed(lambda: report('report_disk_cache'), args.repeat, setup=clear_memory)
+        results['report_memoized'] = timed(lambda: report('report_memoized'), args.repeat)
+    finally:
+        shutil.rmtree(cache.path, ignore_errors=True)
+
+    return results, {'series': len(series), 'era5': len(era_codes), 'cmip6': len(cmip_codes)}
+
+
+def compare(current, other):
+    print(f"\n{'benchmark':<20}{other['revision']:>16}{current['revision']:>16}{'ratio':>10}")
+    for name, result in current['results'].items():
+        if not isinstance(result, dict) or 'median' not in result or name not in other['results']:
+            continue
+        before, after = other['results'][name]['median'], result['median']
+        print(f'{name:<20}{before:>15.3f}s{after:>15.3f}s{after / before:>10.2f}')
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    server, api_url = start_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    try:
+        results, selection = run(args, server, api_url)
+    finally:
+        server.shutdown()
+
+    current = {'revision': git_revision(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'cpus': os.cpu_count(),
+               'region': args.region,
+               'quality': args.quality,
+               'selection': selection,
+               'stub': {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+                        'requests': server.requests, 'errors': server.errors, 'bytes': server.bytes_sent},
+               'results': results}
+
+    for name, result in results.items():
+        if isinstance(result, dict) and 'median' in result:
+            print(f"{name:<20}{result['median']:>10.3f}s (min {result['min']:.3f}s)")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{current['revision']}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(current, f, indent=2)
+    print(f'\nResults written to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(current, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+
+# Series recorded with --record (none are committed, the others are synthetic)
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def fixture_file(fixtures, collection, geocode):
+    return os.path.join(fixtures, f'{collection}__{geocode}.json')
+
+
+def synthetic_series(collection, geocode):
+    # Deterministic stand-in for a series with no recorded fixture: one value per year of the period
+    # in the collection name (e.g. ..._annual_1950-2022_mean_...), keyed like the CCKP API does
+    parts = collection.split('_')
+    start, end = [int(y) for y in parts[5].split('-')]
+    rng = random.Random(zlib.crc32(f'{collection}/{geocode}'.encode()))
+
+    base = rng.uniform(0, 30)
+    trend = rng.uniform(0, 0.05)
+    return {f'{y}-07': round(base + trend * (y - start) + rng.gauss(0, 1), 4) for y in range(start, end + 1)}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Serves GET /<collection>/<geocode>[,<geocode>...]?_format=json as {'data': {geocode: {date: value}}}
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+
+        delay = max(0., random.gauss(server.latency, server.jitter)) if server.jitter else server.latency
+        time.sleep(delay)
+
+        if server.error_rate and random.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            self.send_error(server.error_status)
+            return
+
+        path = urlsplit(self.path).path.strip('/').split('/')
+        if len(path) < 2:
+            self.send_error(404)
+            return
+        collection, geocodes = path[-2], path[-1]
+
+        try:
+            data = {geocode: self.series(collection, geocode) for geocode in geocodes.split(',')}
+        except (ValueError, IndexError):
+            self.send_error(404)
+            return
+
+        body = json.dumps({'data': data}).encode()
+        with server.lock:
+            server.bytes_sent += len(body)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def series(self, collection, geocode):
+        server = self.server
+        file = fixture_file(server.fixtures, collection, geocode)
+
+        if os.path.exists(file):
+            with open(file) as f:
+                return json.load(f)
+
+        if server.upstream is None:
+            return synthetic_series(collection, geocode)
+
+        # Record mode: fetch the series from the real API and keep it as a fixture
+        response = requests.get(f'{server.upstream}/{collection}/{geocode}?_format=json', timeout=60)
+        response.raise_for_status()
+        series = response.json()['data'][geocode]
+
+        os.makedirs(server.fixtures, exist_ok=True)
+        with open(file, 'w') as f:
+            json.dump(series, f)
+
+        return series
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(port=0, latency=0.05, jitter=0., error_rate=0., error_status=500, fixtures=FIXTURES_DIR, upstream=None):
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.error_status = error_status
+    server.fixtures = fixtures
+    server.upstream = upstream
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.errors = 0
+    server.bytes_sent = 0
+
+    return server
+
+
+def start_server(**kwargs):
+    # Serve in a background thread, returns the server and its base URL (to use as CCKP_API_URL)
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for the CCKP API, serving recorded or synthetic series.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every response (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0., help='standard deviation of the latency (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0., help='fraction of the requests answered with an error (default: %(default)s)')
+    parser.add_argument('--error-status', type=int, default=500, help='HTTP status of the injected errors (default: %(default)s)')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help='directory of the recorded series (default: %(default)s)')
+    parser.add_argument('--record', metavar='UPSTREAM', nargs='?', const='https://cckpapi.worldbank.org/cckp/v1',
+                        help='fetch the series without a fixture from UPSTREAM (default: the real CCKP API) and record them')
+
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = make_server(args.port, args.latency, args.jitter, args.error_rate, args.error_status, args.fixtures, args.record)
+    print(f'Serving on http://127.0.0.1:{server.server_address[1]} (set CCKP_API_URL to this address)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,275 @@
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+import cckp_trace
+from cckp_cache import cache
+from cckp_store import store
+
+API_URL = os.environ.get('CCKP_API_URL', 'https://cckpapi.worldbank.org/cckp/v1')
+
+# Maximum number of requests in flight at the same time, in the whole process
+MAX_WORKERS = int(os.environ.get('CCKP_MAX_WORKERS', 16))
+TIMEOUT = 60
+
+# Maximum number of regions asked for in a single request (1 sends one request per series)
+MAX_BATCH = int(os.environ.get('CCKP_MAX_BATCH', 25))
+
+# Status of a batch request with an unknown geocode in it
+BAD_GEOCODE_STATUS = (400, 404)
+
+# One series of the CCKP API, i.e. all the pieces of the request URL
+Series = namedtuple('Series', ['model', 'type', 'var', 'aggregation', 'period', 'percentile', 'scenario',
+                               'model_code', 'model_calculation', 'statistic', 'region_code'])
+
+# CMIP6 ensemble members of a variable, in the order used by the report
+CMIP6_RUNS = [('1950-2014', 'historical'), ('2015-2100', 'ssp126'), ('2015-2100', 'ssp245'), ('2015-2100', 'ssp585')]
+CMIP6_PERCENTILES = ['median', 'p10', 'p90']
+
+_session = None
+_session_lock = threading.Lock()
+
+# Every report and the prefetcher have their own threads: the requests in flight are limited here,
+# so that they never need more connections than the shared pool keeps
+_request_slots = threading.BoundedSemaphore(MAX_WORKERS)
+
+
+class SingleFlight:
+    # Process wide registry of the requests in flight: concurrent callers asking for the same key
+    # (e.g. two Streamlit sessions building a report for the same region) wait for the first one
+    # instead of sending the same request again
+
+    def __init__(self):
+        self.calls = 0
+        self.deduplicated = 0
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            future = self._futures.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._futures[key] = future
+                self.calls += 1
+            else:
+                self.deduplicated += 1
+
+        if not leader:
+            cckp_trace.count('deduplicated')
+            return future.result()
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'deduplicated': self.deduplicated, 'in_flight': len(self._futures)}
+
+
+inflight = SingleFlight()
+
+
+def era5_series(var, region_code):
+    return Series('era5-x0.25', 'timeseries', var, 'annual', '1950-2022', 'mean', 'historical', 'era5', 'x0.25', 'mean', region_code)
+
+
+def cmip6_series(var, region_code):
+    return [Series('cmip6-x0.25', 'timeseries', var, 'annual', period, percentile, scenario, 'ensemble', 'all', 'mean', region_code)
+            for period, scenario in CMIP6_RUNS
+            for percentile in CMIP6_PERCENTILES]
+
+
+def series_name(series):
+    # Short label of a series in traces and messages
+    return f'{series.model} {series.var} {series.scenario} {series.percentile} {series.region_code}'
+
+
+def make_url(series):
+    s = series
+    return f'{API_URL}/{s.model}_{s.type}_{s.var}_{s.type}_{s.aggregation}_{s.period}_{s.percentile}_{s.scenario}_{s.model_code}_{s.model_calculation}_{s.statistic}/{s.region_code}?_format=json'
+
+
+def batch_url(batch):
+    # Same collection for several regions: the API takes a comma separated list of geocodes
+    return make_url(batch[0]._replace(region_code=','.join(s.region_code for s in batch)))
+
+
+def make_batches(series, max_batch=MAX_BATCH):
+    # Group the series differing only by their region, in batches of at most max_batch series
+    groups = {}
+    for s in dict.fromkeys(series):
+        groups.setdefault(s._replace(region_code=None), []).append(s)
+
+    size = max(1, max_batch)
+    return [group[i:i + size] for group in groups.values() for i in range(0, len(group), size)]
+
+
+def get_session():
+    # A single keep-alive connection pool shared by all the fetching threads
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def parse_table(data, series):
+    # The response can hold other regions too (see batch_url)
+    table = pd.DataFrame({series.region_code: data['data'][series.region_code]}).rename_axis('year').reset_index().rename(columns={series.region_code: f'{series.var}_{series.scenario}_{series.percentile}'})
+    table['year'] = pd.to_datetime(table['year'])
+    table = table.set_index('year').resample('Y').mean()
+
+    return table
+
+
+def _from_cache(series):
+    # From memory first, then from the disk
+    with cckp_trace.span('cache', series_name(series), var=series.var) as event:
+        table = store.get(series)
+        event['memory'] = table is not None
+        if table is None:
+            table = cache.get(series)
+            if table is not None:
+                table = store.put(series, table)
+        event['hit'] = table is not None
+    cckp_trace.count('cache_hits' if table is not None else 'cache_misses')
+
+    return table
+
+
+def _fetch_table(series):
+    name = series_name(series)
+
+    table = _from_cache(series)
+    if table is not None:
+        return table
+
+    if cache.offline:
+        raise LookupError(f'{make_url(series)} is not in the cache and offline mode is on')
+
+    # Requesting the data
+    with _request_slots, cckp_trace.span('http', name, var=series.var) as event:
+        response = get_session().get(make_url(series), timeout=TIMEOUT)
+        event['status'] = response.status_code
+        event['bytes'] = len(response.content)
+    cckp_trace.count('requests')
+    cckp_trace.count('bytes_downloaded', len(response.content))
+    response.raise_for_status()
+
+    with cckp_trace.span('parse', name, var=series.var):
+        table = parse_table(response.json(), series)
+    cache.put(series, table)
+
+    return store.put(series, table)
+
+
+def _fetch_batch(batch):
+    # One request for all the series of the batch not in the cache, returns {series: table or error}
+    results = {}
+    missing = []
+    for series in batch:
+        table = _from_cache(series)
+        if table is None:
+            missing.append(series)
+        else:
+            results[series] = table
+    if not missing:
+        return results
+
+    if cache.offline:
+        results.update({s: LookupError(f'{make_url(s)} is not in the cache and offline mode is on') for s in missing})
+        return results
+
+    name = f'{series_name(missing[0])} (+{len(missing) - 1} regions)'
+    with _request_slots, cckp_trace.span('http', name, var=missing[0].var, series=len(missing)) as event:
+        response = get_session().get(batch_url(missing), timeout=TIMEOUT)
+        event['status'] = response.status_code
+        event['bytes'] = len(response.content)
+    cckp_trace.count('requests')
+    cckp_trace.count('bytes_downloaded', len(response.content))
+    response.raise_for_status()
+
+    with cckp_trace.span('parse', name, var=missing[0].var, series=len(missing)):
+        data = response.json()
+        for series in missing:
+            try:
+                results[series] = parse_table(data, series)
+            except KeyError:
+                results[series] = LookupError(f'no data for {series.region_code} in {batch_url(missing)}')
+    for series in missing:
+        if not isinstance(results[series], Exception):
+            cache.put(series, results[series])
+            results[series] = store.put(series, results[series])
+
+    return results
+
+
+def fetch_table(series):
+    return inflight.do(make_url(series), _fetch_table, series)
+
+
+def _fetch_or_error(series):
+    try:
+        return fetch_table(series)
+    except Exception as e:
+        return e
+
+
+def fetch_batch(batch):
+    # {series: table or error} of a batch made by make_batches
+    if len(batch) == 1:
+        return {batch[0]: _fetch_or_error(batch[0])}
+
+    try:
+        return inflight.do(batch_url(batch), _fetch_batch, batch)
+    except requests.HTTPError as e:
+        # A bad geocode fails the whole batch: one request per series finds it without failing the others.
+        # Throttling and server errors fail the batch, retrying each series would only add load.
+        if e.response is not None and e.response.status_code in BAD_GEOCODE_STATUS:
+            return {s: _fetch_or_error(s) for s in batch}
+        return {s: e for s in batch}
+    except Exception as e:
+        return {s: e for s in batch}
+
+
+def fetch_tables(series, max_workers=MAX_WORKERS, return_exceptions=False, max_batch=MAX_BATCH):
+    # Download all the series concurrently, the tables are returned in the same order as the input.
+    # Series of several regions are asked for together (see make_batches).
+    # With return_exceptions the errors are returned in place of the failed tables instead of raised.
+    series = list(series)
+    if not series:
+        return []
+
+    batches = make_batches(series, max_batch)
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as pool:
+        for future in [cckp_trace.submit(pool, fetch_batch, batch) for batch in batches]:
+            results.update(future.result())
+
+    tables = [results[s] for s in series]
+    if not return_exceptions:
+        for table in tables:
+            if isinstance(table, Exception):
+                raise table
+
+    return tables
+
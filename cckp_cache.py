@@ -0,0 +1,151 @@
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = os.environ.get('CCKP_CACHE_DIR', '.cckp_cache')
+CACHE_MAX_MB = float(os.environ.get('CCKP_CACHE_MAX_MB', 500))
+
+# Serve only what is already in the cache, never go to the network
+OFFLINE = os.environ.get('CCKP_OFFLINE', '0') == '1'
+
+# Time to live of a cached series for each dataset (first part of the model name), in seconds
+TTL = {'era5': 30 * 24 * 3600,
+       'cmip6': 365 * 24 * 3600}
+DEFAULT_TTL = 7 * 24 * 3600
+
+# A full cache is brought down to this fraction of its size, so that it is not scanned again at the next entry
+EVICT_TO = 0.9
+
+
+class ResponseCache:
+
+    def __init__(self, path=CACHE_DIR, max_mb=CACHE_MAX_MB, ttl=TTL, offline=OFFLINE):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self.ttl = dict(ttl)
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        # Running total of the size of the entries, None until the directory is scanned
+        self._size = None
+        self._lock = threading.Lock()
+
+    def key(self, series):
+        # The key is the full tuple of URL parameters
+        return '_'.join(series)
+
+    def file(self, series):
+        return os.path.join(self.path, hashlib.sha1(self.key(series).encode()).hexdigest() + '.npz')
+
+    def ttl_of(self, series):
+        return self.ttl.get(series.model.split('-')[0], DEFAULT_TTL)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, series):
+        # Returns the cached table or None. Expired entries are still served in offline mode.
+        file = self.file(series)
+        try:
+            with np.load(file, allow_pickle=False) as npz:
+                key, column, created = str(npz['key']), str(npz['column']), float(npz['created'])
+                index, values = npz['index'], npz['values']
+        except (OSError, KeyError, ValueError):
+            self._count('misses')
+            return None
+
+        if key != self.key(series):
+            self._count('misses')
+            return None
+
+        if not self.offline and time.time() - created > self.ttl_of(series):
+            self._count('expired')
+            self._count('misses')
+            return None
+
+        # The modification time keeps track of the last use, for the LRU eviction
+        try:
+            os.utime(file)
+        except OSError:
+            pass
+
+        self._count('hits')
+        return pd.DataFrame({column: values}, index=pd.DatetimeIndex(index, name='year'))
+
+    def put(self, series, table):
+        os.makedirs(self.path, exist_ok=True)
+        file = self.file(series)
+
+        # Write to a temporary file first, so that readers never see a half written entry
+        tmp = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f,
+                                key=self.key(series),
+                                column=table.columns[0],
+                                created=time.time(),
+                                index=table.index.values.astype('datetime64[ns]'),
+                                values=table.iloc[:, 0].to_numpy(dtype='float64'))
+        try:
+            replaced = os.path.getsize(file)
+        except OSError:
+            replaced = 0
+        os.replace(tmp, file)
+        added = os.path.getsize(file)
+
+        # The directory is scanned only when the cache may be over its size
+        with self._lock:
+            if self._size is not None:
+                self._size += added - replaced
+            full = self._size is None or self._size > self.max_bytes
+        if full:
+            self.evict()
+
+    def evict(self):
+        # Drop the least recently used entries until the cache fits in max_bytes, with some room left
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICT_TO if total > self.max_bytes else total
+
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self._count('evicted')
+
+        # Also corrects the total for the entries written or removed by other processes
+        with self._lock:
+            self._size = total
+
+    def _entries(self):
+        # (last use, size, path) of every cached series
+        entries = []
+        try:
+            for e in os.scandir(self.path):
+                if e.name.endswith('.npz'):
+                    try:
+                        stat = e.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, e.path))
+        except OSError:
+            pass
+
+        return entries
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'expired': self.expired, 'evicted': self.evicted}
+
+
+cache = ResponseCache()
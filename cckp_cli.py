@@ -0,0 +1,119 @@
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cckp_plot
+from cckp_plot import DEFAULT_QUALITY, QUALITY
+from cckp_api import fetch_tables, make_batches
+from cckp_ref import load_ref
+from cckp_report import ERA5_VARIABLES, CMIP6_VARIABLES, build_report, report_file_name, report_series
+from cckp_store import compact, expand
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Write one CCKP climate report (.docx) for each region of a country or for a list of State Codes.')
+
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--country', help='generate the reports for all the regions of this country')
+    target.add_argument('--codes', nargs='+', metavar='STATE_CODE', help='generate the reports for these regions only')
+
+    parser.add_argument('--era5', nargs='*', metavar='VAR', default=ERA5_VARIABLES,
+                        help='ERA5 variables to include (default: all)')
+    parser.add_argument('--cmip6', nargs='*', metavar='VAR', default=None,
+                        help="CMIP6 variables to include, 'all' for all of them (default: the ones also available in ERA5)")
+    parser.add_argument('--out', default='reports', help='output directory (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of regions written in parallel (default: %(default)s)')
+    parser.add_argument('--quality', choices=list(QUALITY), default=DEFAULT_QUALITY,
+                        help='quality of the figures, draft and standard give much smaller files (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+
+    if args.cmip6 is None:
+        args.cmip6 = [var for var in CMIP6_VARIABLES if var in ERA5_VARIABLES]
+    elif args.cmip6 == ['all']:
+        args.cmip6 = CMIP6_VARIABLES
+
+    for name, selected, available in [('ERA5', args.era5, ERA5_VARIABLES), ('CMIP6', args.cmip6, CMIP6_VARIABLES)]:
+        unknown = [var for var in selected if var not in available]
+        if unknown:
+            parser.error(f"unknown {name} variables: {', '.join(unknown)}")
+
+    return parser, args
+
+
+def get_regions(ref, country=None, codes=None):
+    # (country, region, State Code) of the regions to write
+    if country is not None:
+        if country not in ref.regions:
+            raise KeyError(f'unknown country: {country}')
+        return [(country, region, ref.state_codes[(country, region)]) for region in ref.regions[country]]
+
+    by_code = {code: key for key, code in ref.state_codes.items()}
+    unknown = [code for code in codes if code not in by_code]
+    if unknown:
+        raise KeyError(f"unknown State Codes: {', '.join(unknown)}")
+
+    return [(*by_code[code], code) for code in dict.fromkeys(codes)]
+
+
+def write_report(country, region, region_code, era_codes, cmip_codes, tables, out, quality=DEFAULT_QUALITY):
+    # Runs in a worker process: the figures are drawn by the worker itself
+    cckp_plot.RENDER_WORKERS = 0
+
+    tables = [expand(table) for table in tables]
+    doc = build_report(country, region, region_code, era_codes, cmip_codes, tables=tables, quality=quality, log=lambda msg: None)
+    path = os.path.join(out, report_file_name(country, region))
+    doc.save(path)
+
+    return path
+
+
+def main(argv=None):
+    parser, args = parse_args(argv)
+
+    try:
+        regions = get_regions(load_ref(), args.country, args.codes)
+    except KeyError as e:
+        parser.error(e.args[0])
+
+    os.makedirs(args.out, exist_ok=True)
+
+    # Series shared between regions are downloaded only once
+    series = {r: report_series(r[2], args.era5, args.cmip6) for r in regions}
+    unique = list(dict.fromkeys(s for region_series in series.values() for s in region_series))
+
+    print(f'Downloading {len(unique)} series for {len(regions)} regions in {len(make_batches(unique))} requests')
+    # Kept compact until each worker expands the tables of its region
+    fetched = {s: t if isinstance(t, Exception) else compact(t) for s, t in zip(unique, fetch_tables(unique, return_exceptions=True))}
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {}
+        for r in regions:
+            tables = [fetched[s] for s in series[r]]
+            errors = [t for t in tables if isinstance(t, Exception)]
+            if errors:
+                print(f'{r[1]} ({r[2]}): download failed ({errors[0]})', file=sys.stderr)
+                failed += 1
+                continue
+
+            futures[pool.submit(write_report, *r, args.era5, args.cmip6, tables, args.out, args.quality)] = r
+
+        for future in as_completed(futures):
+            country, region, region_code = futures[future]
+            try:
+                print(future.result())
+            except Exception as e:
+                print(f'{region} ({region_code}): failed ({e})', file=sys.stderr)
+                failed += 1
+
+    print(f'{len(regions) - failed} reports written to {args.out}, {failed} failed')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
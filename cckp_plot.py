@@ -0,0 +1,207 @@
+import multiprocessing
+import os
+import threading
+import warnings
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from io import BytesIO
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from PIL import Image
+
+from cckp_ref import load_ref
+
+# Number of processes drawing the figures, 0 draws them in the calling process
+RENDER_WORKERS = int(os.environ.get('CCKP_RENDER_WORKERS', min(os.cpu_count() or 1, 8)))
+
+# Quality profiles of the figures: resolution, size in inches and number of colors of the PNG palette
+# (None keeps the full color PNG written by matplotlib)
+Quality = namedtuple('Quality', ['dpi', 'figsize', 'colors'])
+QUALITY = {'draft': Quality(100, (6, 3), 64),
+           'standard': Quality(200, (6, 3), 256),
+           'print': Quality(300, (6, 3), None)}
+DEFAULT_QUALITY = os.environ.get('CCKP_QUALITY', 'print')
+if DEFAULT_QUALITY not in QUALITY:
+    warnings.warn(f"CCKP_QUALITY must be one of {', '.join(QUALITY)}, not {DEFAULT_QUALITY!r}: using 'print'")
+    DEFAULT_QUALITY = 'print'
+
+# Everything needed to draw a figure, cheap to send to a worker process
+PlotSpec = namedtuple('PlotSpec', ['kind', 'tables', 'title', 'unit'])
+
+_pool = None
+_pool_lock = threading.Lock()
+_render_lock = threading.Lock()
+
+
+def make_plot_single(table, var):
+    v = load_ref().variables[var]
+    return PlotSpec('single', [table], v.name, v.unit)
+
+
+def make_plot_multi(rolled, var):
+    # rolled is the 5 years rolling mean of the ensemble of cckp_report.make_ensemble
+    v = load_ref().variables[var]
+    return PlotSpec('multi', [rolled], v.name, v.unit)
+
+
+def draw_single(ax, table):
+    table.plot(ax=ax, legend=False, color='black', linewidth=0.5, label='Yearly value')
+    table.rolling(5, center=True).mean().plot(ax=ax, legend=False, color='red', linewidth=2. , label='5yr rolling mean')
+
+    #put legend outside right
+    ax.legend(['Yearly value', '5yr rolling mean'], loc='center left', bbox_to_anchor=(1, 0.8), frameon=False)
+
+
+def draw_multi(ax, rolled):
+    # Median, lower and upper of historical, ssp126, ssp245 and ssp585
+    for scenario, color in zip(['historical', 'ssp126', 'ssp245', 'ssp585'], ['blue', 'green', 'orange', 'red']):
+        rolled[(scenario, 'median')].plot(ax=ax, color=color, linewidth=2.)
+        rolled[(scenario, 'p10')].plot(ax=ax, color=color, linewidth=0.5, linestyle=':')
+        rolled[(scenario, 'p90')].plot(ax=ax, color=color, linewidth=0.5, linestyle='--')
+
+    ax.plot([],[], color='black', linewidth=0, label=' ')
+    ax.plot([],[], color='black', linewidth=2., label='Median')
+    ax.plot([],[], color='black', linewidth=0.5, linestyle=':', label='Lower')
+    ax.plot([],[], color='black', linewidth=0.5, linestyle='--', label='Upper')
+
+    #put legend outside right
+    handles, labels = ax.get_legend_handles_labels()
+    ax.legend(list( handles[i] for i in [0,3,6,9,12,13,14,15] ), ['Historical','SSP 1-2.6','SSP 2-4.5','SSP 5-8.5',' ','Median','Lower','Upper'], loc='center left', bbox_to_anchor=(1, 0.5), frameon=False)
+
+
+def make_figure(spec, figsize=(6, 3)):
+    # The figure is not registered in pyplot, so it is freed as soon as it is not referenced anymore
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot()
+
+    if spec.kind == 'single':
+        draw_single(ax, spec.tables[0])
+    else:
+        draw_multi(ax, spec.tables[0])
+
+    # hide axis spines
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+
+    ax.set_ylabel(spec.unit)
+    ax.set_title(spec.title)
+    ax.grid(True)
+
+    return fig
+
+
+def quantize_png(png, colors, dpi):
+    # The figures have a few flat colors, so a small palette without dithering keeps them sharp
+    with Image.open(BytesIO(png)) as image:
+        image = image.convert('RGB').quantize(colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+
+    bio = BytesIO()
+    image.save(bio, format='png', optimize=True, dpi=(dpi, dpi))
+    return bio.getvalue()
+
+
+def render_png(spec, quality=DEFAULT_QUALITY):
+    q = QUALITY[quality]
+    fig = make_figure(spec, q.figsize)
+    try:
+        bio = BytesIO()
+        fig.savefig(bio, format='png', bbox_inches='tight', dpi=q.dpi)
+    finally:
+        fig.clear()
+
+    if q.colors is None:
+        return bio.getvalue()
+    return quantize_png(bio.getvalue(), q.colors, q.dpi)
+
+
+def timed_render_png(spec, quality=DEFAULT_QUALITY):
+    # The PNG bytes and the time spent drawing and saving them, without the time waiting for a worker
+    start = time.perf_counter()
+    png = render_png(spec, quality)
+    return png, time.perf_counter() - start
+
+
+def get_pool():
+    # Spawned, not forked: the Streamlit server is multithreaded
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def reset_pool(pool):
+    # A worker died (e.g. killed when out of memory) and the pool cannot be used anymore: the next call starts a new one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def render_pngs(specs, quality=DEFAULT_QUALITY):
+    # PNG bytes of all the figures, in the same order as the specs
+    specs = list(specs)
+    if RENDER_WORKERS == 0 or len(specs) < 2:
+        # pandas plotting is not thread safe, same lock as submit_png
+        with _render_lock:
+            return [render_png(spec, quality) for spec in specs]
+
+    # Tried again once in a new pool if a worker dies
+    for retry in [True, False]:
+        pool = get_pool()
+        try:
+            return list(pool.map(partial(render_png, quality=quality), specs))
+        except BrokenProcessPool:
+            reset_pool(pool)
+            if not retry:
+                raise
+
+
+def submit_png(spec, quality=DEFAULT_QUALITY):
+    # Future of (PNG bytes, drawing time) of one figure, for callers that want each figure as soon as it is ready
+    if RENDER_WORKERS == 0:
+        future = Future()
+        try:
+            # pandas plotting is not thread safe, draw one figure at a time
+            with _render_lock:
+                future.set_result(timed_render_png(spec, quality))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    result = Future()
+
+    def submit(retry):
+        # Tried again once in a new pool if a worker dies
+        pool = get_pool()
+        try:
+            future = pool.submit(timed_render_png, spec, quality)
+        except BrokenProcessPool as e:
+            future = Future()
+            future.set_exception(e)
+
+        def done(future):
+            if future.cancelled():
+                result.cancel()
+                return
+            e = future.exception()
+            if isinstance(e, BrokenProcessPool):
+                reset_pool(pool)
+                if retry:
+                    submit(False)
+                    return
+            if e is not None:
+                result.set_exception(e)
+            else:
+                result.set_result(future.result())
+
+        future.add_done_callback(done)
+
+    submit(True)
+    return result
@@ -0,0 +1,70 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cckp_api import fetch_table
+from cckp_cache import cache
+
+# Threads downloading in the background, shared by all the sessions (0 disables the prefetch)
+PREFETCH_WORKERS = int(os.environ.get('CCKP_PREFETCH_WORKERS', 4))
+
+# Maximum number of series waiting to be prefetched, for all the sessions together
+MAX_PENDING = int(os.environ.get('CCKP_PREFETCH_MAX_PENDING', 1000))
+
+
+class Prefetcher:
+    # Downloads series into the disk cache before they are asked for. Each owner (a Streamlit session)
+    # has at most one prefetch going on: a new one cancels the series of the previous one not started yet.
+    # Series already downloading are joined by fetch_table through the single-flight registry.
+
+    def __init__(self, max_workers=PREFETCH_WORKERS, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self.prefetched = 0
+        self.cancelled = 0
+        self.failed = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cckp-prefetch') if max_workers > 0 else None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, series):
+        try:
+            fetch_table(series)
+        except Exception:
+            # Not needed right now: the report will try again and show the error
+            with self._lock:
+                self.failed += 1
+        else:
+            with self._lock:
+                self.prefetched += 1
+
+    def pending(self):
+        with self._lock:
+            return sum(not future.done() for futures in self._jobs.values() for future in futures)
+
+    def prefetch(self, owner, series):
+        # Series are downloaded in the given order, the first ones are the first needed
+        self.cancel(owner)
+        if self._pool is None or cache.offline:
+            return
+
+        series = list(series)[:max(0, self.max_pending - self.pending())]
+        futures = [self._pool.submit(self._fetch, s) for s in series]
+        with self._lock:
+            # Forget the owners whose prefetch is over, e.g. closed sessions
+            self._jobs = {o: f for o, f in self._jobs.items() if not all(future.done() for future in f)}
+            self._jobs[owner] = futures
+
+    def cancel(self, owner):
+        with self._lock:
+            futures = self._jobs.pop(owner, [])
+        cancelled = sum(future.cancel() for future in futures)
+        with self._lock:
+            self.cancelled += cancelled
+
+    def stats(self):
+        pending = self.pending()
+        with self._lock:
+            return {'prefetched': self.prefetched, 'cancelled': self.cancelled, 'failed': self.failed, 'pending': pending}
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,79 @@
+import os
+import pickle
+import threading
+from collections import namedtuple
+
+import pandas as pd
+
+from cckp_cache import CACHE_DIR
+
+REF_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geonames.xlsx')
+
+Variable = namedtuple('Variable', ['code', 'name', 'unit', 'description'])
+
+# Lookup tables built from the Regions and Variables sheets of geonames.xlsx
+RefData = namedtuple('RefData', ['variables',    # code -> Variable
+                                 'codes',        # variable name -> code
+                                 'regions',      # country -> list of states
+                                 'state_codes',  # (country, state) -> State Code
+                                 ])
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def build_ref(path=REF_FILE):
+    geo_ref = pd.read_excel(path, sheet_name='Regions')
+    var_ref = pd.read_excel(path, sheet_name='Variables')
+
+    variables = {}
+    for code, name, unit, description in var_ref[['Code', 'Variable', 'Unit', 'Description']].itertuples(index=False):
+        variables.setdefault(code, Variable(code, name, unit, description))
+    codes = {}
+    for v in variables.values():
+        codes.setdefault(v.name, v.code)
+
+    regions = {}
+    state_codes = {}
+    for country, state, state_code in geo_ref[['Country', 'State', 'State Code']].itertuples(index=False):
+        states = regions.setdefault(country, [])
+        if state not in states:
+            states.append(state)
+        state_codes.setdefault((country, state), state_code)
+
+    return RefData(variables, codes, regions, state_codes)
+
+
+def load_ref(path=REF_FILE, cache_dir=CACHE_DIR):
+    # The xlsx is parsed only when it changes: the lookup tables are kept in memory for the whole
+    # process and pickled next to the series cache so that a restart does not parse it again
+    mtime = os.stat(path).st_mtime_ns
+
+    with _lock:
+        ref = _loaded.get(path)
+        if ref is not None and ref[0] == mtime:
+            return ref[1]
+
+        pkl = os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + '.pkl')
+        data = None
+        try:
+            with open(pkl, 'rb') as f:
+                saved_mtime, data = pickle.load(f)
+            if saved_mtime != mtime:
+                data = None
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            data = None
+
+        if data is None:
+            data = build_ref(path)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp = f'{pkl}.{os.getpid()}.tmp'
+                with open(tmp, 'wb') as f:
+                    pickle.dump((mtime, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, pkl)
+            except OSError:
+                pass
+
+        _loaded[path] = (mtime, data)
+        return data
@@ -0,0 +1,403 @@
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from docx import Document
+from docx.shared import RGBColor, Pt
+from docx.enum.text import WD_BREAK
+
+import cckp_trace
+from cckp_api import CMIP6_PERCENTILES, CMIP6_RUNS, MAX_WORKERS, fetch_table, fetch_tables, era5_series, cmip6_series
+from cckp_ref import load_ref
+from cckp_plot import DEFAULT_QUALITY, make_plot_single, make_plot_multi, render_pngs, submit_png
+
+ERA5_VARIABLES = ['tas','tasmax','tasmin','tnn','tr','txx','fd','pr','rx1day','rx5day']
+CMIP6_VARIABLES = ['tas', 'tasmax', 'tasmin', 'tnn', 'tr', 'txx', 'fd','hd30', 'hd35', 'hd40', 'hd45', 'hdd65', 'id',  'cdd65', 'sd',  'tr23', 'tr26', 'tr29', 'pr', 'rx1day', 'rx5day', 'cdd', 'cwd',    'prpercnt', 'r20mm', 'r50mm']
+
+# Years in the tables of the report
+ERA5_DECADES = list(range(1950, 2021, 10))
+CMIP6_DECADES = list(range(2020, 2101, 10))
+TABLE_SCENARIOS = ['ssp126', 'ssp245', 'ssp585']
+
+# Memory for the report sections kept by the process (mostly their figures)
+SECTION_CACHE_MAX_MB = float(os.environ.get('CCKP_SECTION_CACHE_MAX_MB', 100))
+
+# Stand-ins for the names in the document skeleton, replaced in each report
+COUNTRY_PLACEHOLDER = '{{country}}'
+REGION_PLACEHOLDER = '{{region}}'
+
+_skeleton = None
+_skeleton_lock = threading.Lock()
+
+
+def set_up_doc(country, region):
+
+    doc = Document()
+    style = doc.styles['Normal']
+    style.paragraph_format.line_spacing = 1.15
+    style.font.color.rgb = RGBColor(0, 0, 0)
+    style.font.name = "Calibri"
+    style.font.size = Pt(11)
+
+    title = doc.add_heading('Climate and Climate Change', level=1)
+    title.style.font.color.rgb = RGBColor(0, 0, 0)
+    title.bold = True
+    title.style.font.name = "Calibri"
+    title.style.font.size = Pt(11)
+    title.add_run().add_break(WD_BREAK.LINE)
+
+    met = doc.add_heading('Methodology', level=2)
+    met.style.font.color.rgb = RGBColor(0, 0, 0)
+    met.bold = True
+    met.style.font.name = "Calibri"
+    met.style.font.size = Pt(11)
+    met.add_run().add_break(WD_BREAK.LINE)
+
+    met_desc = [f'The climatic characterization and the analysis of the possible future evolution of the climate for {region}, {country} was carried out through the analysis of the following data:', 
+                'For the historical climatic trends, data from the ERA5  (European ReAnalysis version5) reanalysis system were used, which provides hourly estimates of numerous atmospheric, terrestrial and oceanic climatic variables. The data covers the Earth on a 30 km grid and resolves the atmosphere using 137 levels from the surface to an altitude of 80 km. Information on uncertainties is also provided for variables with low spatial and temporal resolutions. Quality assured monthly updates of ERA5 (1950 to present) are released within 3 months in real time. Preliminary daily dataset updates are available to users within 5 days in real time.',
+                'Finally, data relating to climate projections for the period 2014-2100 were obtained from the Coupled Model Intercomparison Project Phase 6 (CMIP6)  a project of the Working Group on Coupled Modeling (WGCM) of the World Climate Reserach Program (WGCM), which coordinates since 1995 the global climate modeling experiments carried out by various working groups (for Italy by the Euro-Mediterranean Center for Climate Change (CMCC)), through the definition of common protocols and drivers for all models. The data is made available on a 100x100km grid and for a series of socio-economic scenarios (Shared Socioeconomic Pathways - SSP) which reflect different possible evolution scenarios of greenhouse gas emissions.',
+                'The data used are those referring to the Multi model ensemble for the following scenarios:',
+                'SSP1-2.6: optimistic scenario in which global CO2 emissions are drastically reduced reaching net zero after 2050 thanks to an evolution of societies towards environmental and social sustainability and temperatures stabilize around 1.8°C more by the end of the century.',
+                'SSP2-4.5: Intermediate scenario in which CO2 emissions hover around current levels before starting to decline mid-century but fail to reach net zero by 2100. Socio-economic factors follow their historical trends without significant changes. Progress towards sustainability is slow, with development and income growing unevenly. In this scenario, temperatures rise by 2.7°C by the end of the century.', 
+                'SSP5-8.5: Scenario where current CO2 emission levels roughly double by 2050. The global economy is growing rapidly, but this growth is fueled by fossil fuel exploitation and high-intensive lifestyles energy. By 2100, the global average temperature will be as much as 4.4°C higher.']
+    
+    a = [doc.add_paragraph(met) for met in met_desc]
+
+    reg = doc.add_heading('Regional climatology', level=2)
+    reg.style.font.color.rgb = RGBColor(0, 0, 0)
+    reg.bold = True
+    reg.style.font.name = "Calibri"
+    reg.style.font.size = Pt(11)
+    reg.add_run().add_break(WD_BREAK.LINE)
+
+    reg_desc = [f'ADD GENERICAL CLIMATE INFORMATION FOR {region}, {country}. Reliable sources are the CCKP, Wikipedia, ...',
+                'You can follow the scheme: climate classification of the region according to Kopper']
+
+    a = [doc.add_paragraph(reg) for reg in reg_desc]
+
+
+    return doc
+
+
+def add_title(doc, text):
+    title = doc.add_heading(text, level=2)
+    title.style.font.color.rgb = RGBColor(0, 0, 0)
+    title.bold = True
+    title.style.font.name = "Calibri"
+    title.style.font.size = Pt(11)
+    title.add_run().add_break(WD_BREAK.LINE)
+
+    return title
+
+
+def report_skeleton():
+    # The beginning of every report (set_up_doc and the ERA5 title) with placeholders for the names,
+    # built once and kept as a .docx file
+    global _skeleton
+    with _skeleton_lock:
+        if _skeleton is None:
+            doc = set_up_doc(COUNTRY_PLACEHOLDER, REGION_PLACEHOLDER)
+            doc.add_page_break()
+            add_title(doc, 'Historical trends of the main climatic indicators from ERA5')
+
+            bio = BytesIO()
+            doc.save(bio)
+            _skeleton = bio.getvalue()
+        return _skeleton
+
+
+def new_report(country, region):
+    # A copy of the skeleton for this region
+    doc = Document(BytesIO(report_skeleton()))
+    for paragraph in doc.paragraphs:
+        for run in paragraph.runs:
+            if COUNTRY_PLACEHOLDER in run.text or REGION_PLACEHOLDER in run.text:
+                run.text = run.text.replace(COUNTRY_PLACEHOLDER, country).replace(REGION_PLACEHOLDER, region)
+
+    return doc
+
+
+def add_table(doc, header, rows, style=None):
+    # The table is created with all its rows at once, add_row copies the last row every time
+    table = doc.add_table(rows=len(rows) + 1, cols=len(header), style=style)
+    for row, values in zip(table.rows, [header, *rows]):
+        for cell, text in zip(row.cells, values):
+            cell.text = text
+
+    return table
+
+
+# One variable of the report: everything needed to write it in the document
+Section = namedtuple('Section', ['dataset', 'var', 'title', 'png', 'description', 'header', 'rows'])
+
+
+class SectionCache:
+    # Sections already built, shared by all the reports of the process and keyed by
+    # (region_code, dataset, var, quality profile). The least recently used are dropped first.
+
+    def __init__(self, max_mb=SECTION_CACHE_MAX_MB):
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self.hits = 0
+        self.misses = 0
+        self._sections = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            section = self._sections.get(key)
+            if section is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._sections.move_to_end(key)
+        cckp_trace.count('section_misses' if section is None else 'section_hits')
+        return section
+
+    def put(self, key, section):
+        # The size of a section is the size of its figure, the rest is small
+        with self._lock:
+            old = self._sections.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.png)
+            self._sections[key] = section
+            self._bytes += len(section.png)
+            while self._bytes > self.max_bytes and self._sections:
+                _, dropped = self._sections.popitem(last=False)
+                self._bytes -= len(dropped.png)
+
+    def clear(self):
+        with self._lock:
+            self._sections.clear()
+            self._bytes = 0
+
+
+sections = SectionCache()
+
+
+def era5_rows(tab):
+    # Decade rows taken with a single index on the years
+    values = tab.iloc[:, 0].set_axis(tab.index.year).reindex(ERA5_DECADES).to_numpy()
+
+    return [[str(y), f'{v:6.2f}'] for y, v in zip(ERA5_DECADES, values)]
+
+
+def cmip6_rows(rolled):
+    # Decade rows of the 5 years rolling median of the three scenarios
+    block = rolled.set_axis(rolled.index.year)[[(scenario, 'median') for scenario in TABLE_SCENARIOS]].reindex(CMIP6_DECADES).to_numpy()
+
+    return [[str(y)] + [f'{v:6.2f}' for v in values] for y, values in zip(CMIP6_DECADES, block)]
+
+
+def make_ensemble(tables):
+    # The 12 tables of a CMIP6 variable (in the order of cmip6_series) as one wide, year indexed table
+    # with a (scenario, percentile) column for each of them, backed by a single NumPy block
+    index = tables[0].index
+    for table in tables[1:]:
+        index = index.union(table.index)
+
+    values = np.full((len(index), len(tables)), np.nan)
+    for j, table in enumerate(tables):
+        values[index.get_indexer(table.index), j] = table.iloc[:, 0].to_numpy()
+
+    columns = pd.MultiIndex.from_tuples([(scenario, percentile) for _, scenario in CMIP6_RUNS for percentile in CMIP6_PERCENTILES],
+                                        names=['scenario', 'percentile'])
+
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+def prepare_data(dataset, group):
+    # What the figure and the table of a section are made of: the yearly ERA5 table,
+    # or the 5 years rolling mean of the whole CMIP6 ensemble, computed once for both
+    if dataset == 'era5':
+        return group[0]
+    return make_ensemble(group).rolling(5).mean()
+
+
+def make_spec(dataset, var, data):
+    if dataset == 'era5':
+        return make_plot_single(data, var)
+    return make_plot_multi(data, var)
+
+
+def make_section(dataset, var, data, png):
+    v = load_ref().variables[var]
+
+    if dataset == 'era5':
+        header = ['Year', f'ERA5 value [{v.unit}]']
+        rows = era5_rows(data)
+    else:
+        header = ['Year', f'SSP 1-2.6 [{v.unit}]', f'SSP 2-4.5 [{v.unit}]', f'SSP 5-8.5 [{v.unit}]']
+        rows = cmip6_rows(data)
+
+    return Section(dataset, var, v.name, png, v.description, header, rows)
+
+
+def add_section(doc, section):
+    p = doc.add_paragraph().add_run(section.title)
+
+    p.bold = True
+    p.italic = True
+    doc.add_picture(BytesIO(section.png))
+    doc.add_paragraph().add_run(section.description)
+
+    add_table(doc, section.header, section.rows, style='Colorful List')
+    doc.add_page_break() 
+
+
+def section_series(dataset, var, region_code):
+    if dataset == 'era5':
+        return [era5_series(var, region_code)]
+    return cmip6_series(var, region_code)
+
+
+def report_series(region_code, era_codes, cmip_codes):
+    # The ERA5 series first and then 12 for each CMIP6 variable
+    series = [era5_series(var, region_code) for var in era_codes]
+    for var in cmip_codes:
+        series += cmip6_series(var, region_code)
+
+    return series
+
+
+def requested_sections(era_codes, cmip_codes):
+    return [('era5', var) for var in era_codes] + [('cmip6', var) for var in cmip_codes]
+
+
+def build_sections(region_code, era_codes, cmip_codes, tables=None, quality=DEFAULT_QUALITY, log=print):
+    # Sections of the report, in order. Only the ones not built yet are fetched and drawn.
+    # tables, when given, are the tables of report_series() already downloaded.
+    requested = requested_sections(era_codes, cmip_codes)
+    result = {item: sections.get((region_code, *item, quality)) for item in requested}
+    missing = [item for item in requested if result[item] is None]
+
+    if missing:
+        if tables is None:
+            log('**Downloading data**')
+            series = [section_series(dataset, var, region_code) for dataset, var in missing]
+            fetched = iter(fetch_tables(s for group in series for s in group))
+            groups = [[next(fetched) for _ in group] for group in series]
+        else:
+            tables = iter(tables)
+            all_groups = {item: [next(tables) for _ in section_series(*item, region_code)] for item in requested}
+            groups = [all_groups[item] for item in missing]
+
+        with cckp_trace.span('prepare', 'all sections'):
+            data = [prepare_data(dataset, group) for (dataset, var), group in zip(missing, groups)]
+
+        log('**Drawing figures**')
+
+        # All the figures are drawn in parallel, in memory
+        with cckp_trace.span('render', 'all figures', figures=len(missing)) as event:
+            pngs = render_pngs([make_spec(dataset, var, d) for (dataset, var), d in zip(missing, data)], quality=quality)
+            event['bytes'] = sum(len(png) for png in pngs)
+
+        for (dataset, var), d, png in zip(missing, data, pngs):
+            section = make_section(dataset, var, d, png)
+            sections.put((region_code, dataset, var, quality), section)
+            result[(dataset, var)] = section
+
+    return [result[item] for item in requested]
+
+
+def iter_sections(region_code, era_codes, cmip_codes, quality=DEFAULT_QUALITY):
+    # Yields (position, (dataset, var), section) as soon as each section of the report is ready,
+    # the already built ones first. A section that fails is yielded as the exception, the others go on.
+    requested = requested_sections(era_codes, cmip_codes)
+
+    missing = []
+    for i, item in enumerate(requested):
+        section = sections.get((region_code, *item, quality))
+        if section is None:
+            missing.append((i, item))
+        else:
+            yield i, item, section
+
+    if not missing:
+        return
+
+    def build(item, futures):
+        dataset, var = item
+        tables = [future.result() for future in futures]
+
+        with cckp_trace.span('prepare', f'{dataset} {var}', var=var, dataset=dataset):
+            data = prepare_data(dataset, tables)
+
+        # The time waiting for a render worker is recorded apart, it depends on the other figures
+        start = time.perf_counter()
+        png, duration = submit_png(make_spec(dataset, var, data), quality).result()
+        cckp_trace.record('render_queue', f'{dataset} {var}', time.perf_counter() - start - duration, var=var, dataset=dataset)
+        cckp_trace.record('render', f'{dataset} {var}', duration, var=var, dataset=dataset, quality=quality, bytes=len(png))
+        cckp_trace.count('png_bytes', len(png))
+
+        section = make_section(dataset, var, data, png)
+        sections.put((region_code, dataset, var, quality), section)
+        return section
+
+    fetch_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    build_pool = ThreadPoolExecutor(max_workers=min(len(missing), MAX_WORKERS))
+    try:
+        # The series are requested in the order of the report, so the first sections are the first ready
+        jobs = {}
+        for i, item in missing:
+            futures = [cckp_trace.submit(fetch_pool, fetch_table, s) for s in section_series(*item, region_code)]
+            jobs[cckp_trace.submit(build_pool, build, item, futures)] = (i, item)
+
+        for job in as_completed(jobs):
+            i, item = jobs[job]
+            try:
+                yield i, item, job.result()
+            except Exception as e:
+                yield i, item, e
+    finally:
+        # Stop downloading if the caller does not want the rest of the report
+        fetch_pool.shutdown(wait=False, cancel_futures=True)
+        build_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def assemble_report(country, region, era_sections, cmip_sections):
+    # Write the sections in a new document, missing (None) sections are left out
+    with cckp_trace.span('docx', 'assemble', sections=sum(s is not None for s in [*era_sections, *cmip_sections])):
+        doc = new_report(country, region)
+
+        for section in era_sections:
+            if section is not None:
+                add_section(doc, section)
+
+        add_title(doc, 'Future projections of key climate indicators from CMIP6')
+
+        for section in cmip_sections:
+            if section is not None:
+                add_section(doc, section)
+
+    return doc
+
+
+def save_report(doc):
+    # The .docx file as bytes
+    with cckp_trace.span('docx', 'save') as event:
+        bio = BytesIO()
+        doc.save(bio)
+        data = bio.getvalue()
+        event['bytes'] = len(data)
+    cckp_trace.count('docx_bytes', len(data))
+
+    return data
+
+
+def build_report(country, region, region_code, era_codes, cmip_codes, tables=None, quality=DEFAULT_QUALITY, log=print):
+    # Fetch, plot and write the whole report. The tables can be passed in when they were already downloaded.
+    report_sections = build_sections(region_code, era_codes, cmip_codes, tables=tables, quality=quality, log=log)
+
+    log('**Writing the report**')
+
+    return assemble_report(country, region, report_sections[:len(era_codes)], report_sections[len(era_codes):])
+
+
+def report_file_name(country, region):
+    return f"{country}_{region}.docx".replace(os.sep, '-')
@@ -0,0 +1,90 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Memory for the series kept by the process, shared by all the sessions
+STORE_MAX_MB = float(os.environ.get('CCKP_STORE_MAX_MB', 64))
+
+# Years are stored as offsets from this one
+BASE_YEAR = 1900
+
+# A yearly table in 6 bytes per year: the years as int16 offsets and the values as float32,
+# both read-only so that the same arrays can be handed to every caller
+CompactSeries = namedtuple('CompactSeries', ['column', 'years', 'values'])
+
+
+def compact(table):
+    years = (table.index.year - BASE_YEAR).to_numpy(dtype='int16')
+    values = table.iloc[:, 0].to_numpy(dtype='float32')
+    years.flags.writeable = False
+    values.flags.writeable = False
+
+    return CompactSeries(table.columns[0], years, values)
+
+
+def expand(series):
+    # Back to the table of cckp_api.parse_table: the values indexed by the last day of each year
+    years = series.years.astype('int64') + (BASE_YEAR - 1970 + 1)
+    index = pd.DatetimeIndex(years.astype('datetime64[Y]').astype('datetime64[ns]') - np.timedelta64(1, 'D'), name='year')
+
+    return pd.DataFrame({series.column: series.values.astype('float64')}, index=index)
+
+
+def nbytes(series):
+    return series.years.nbytes + series.values.nbytes
+
+
+class SeriesStore:
+    # The series used recently, kept in memory in compact form up to max_mb.
+    # The least recently used are dropped first.
+
+    def __init__(self, max_mb=STORE_MAX_MB):
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self.hits = 0
+        self.misses = 0
+        self._series = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, series):
+        # The table or None, a new DataFrame every time
+        with self._lock:
+            stored = self._series.get(series)
+            if stored is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._series.move_to_end(series)
+
+        return expand(stored)
+
+    def put(self, series, table):
+        # Returns the table as get() will, so that a series has the same values whether stored or not
+        stored = compact(table)
+        with self._lock:
+            old = self._series.pop(series, None)
+            if old is not None:
+                self._bytes -= nbytes(old)
+            self._series[series] = stored
+            self._bytes += nbytes(stored)
+
+            while self._bytes > self.max_bytes and self._series:
+                _, dropped = self._series.popitem(last=False)
+                self._bytes -= nbytes(dropped)
+
+        return expand(stored)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'series': len(self._series), 'bytes': self._bytes}
+
+
+store = SeriesStore()
@@ -0,0 +1,113 @@
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+_current = contextvars.ContextVar('cckp_trace', default=None)
+
+
+class Trace:
+    # Timings and counters of one run of the report pipeline. Every stage is recorded as an event
+    # {'stage', 'name', 'start', 'duration', ...attributes}, start is relative to the beginning of the trace.
+
+    def __init__(self, **attrs):
+        self.attrs = attrs
+        self.events = []
+        self.counters = {}
+        self._start = time.perf_counter()
+        self._created = time.time()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, name=None, **attrs):
+        # The event is yielded so that attributes known only at the end (e.g. bytes) can be added
+        event = {'stage': stage, 'name': name, **attrs}
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException as e:
+            event['error'] = repr(e)
+            raise
+        finally:
+            event['start'] = start - self._start
+            event['duration'] = time.perf_counter() - start
+            with self._lock:
+                self.events.append(event)
+
+    def record(self, stage, name=None, duration=0., **attrs):
+        # An event measured elsewhere (e.g. in another process), ending now
+        end = time.perf_counter()
+        event = {'stage': stage, 'name': name, **attrs, 'start': end - duration - self._start, 'duration': duration}
+        with self._lock:
+            self.events.append(event)
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def stages(self):
+        # Number of events, total, mean and maximum duration of each stage
+        summary = {}
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            s = summary.setdefault(event['stage'], {'count': 0, 'total': 0., 'max': 0.})
+            s['count'] += 1
+            s['total'] += event['duration']
+            s['max'] = max(s['max'], event['duration'])
+        for s in summary.values():
+            s['mean'] = s['total'] / s['count']
+
+        return summary
+
+    def to_dict(self):
+        stages = self.stages()
+        with self._lock:
+            return {'created': self._created,
+                    'elapsed': time.perf_counter() - self._start,
+                    **self.attrs,
+                    'counters': dict(self.counters),
+                    'stages': stages,
+                    'events': sorted(self.events, key=lambda e: e['start'])}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, default=str)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def tracing(trace):
+    # Record what runs in this context (and in the tasks submitted with submit) into trace
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+def span(stage, name=None, **attrs):
+    trace = _current.get()
+    if trace is None:
+        return nullcontext({})
+    return trace.span(stage, name, **attrs)
+
+
+def record(stage, name=None, duration=0., **attrs):
+    trace = _current.get()
+    if trace is not None:
+        trace.record(stage, name, duration, **attrs)
+
+
+def count(counter, value=1):
+    trace = _current.get()
+    if trace is not None:
+        trace.count(counter, value)
+
+
+def submit(pool, fn, *args, **kwargs):
+    # Executors do not carry the context to their threads, so each task runs in a copy of the caller's
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)